@@ -1,5 +1,9 @@
 import re
+import os
+import time
+import struct
 import urllib
+import hashlib
 import logging
 import cookielib
 from BeautifulSoup import BeautifulSoup, NavigableString
@@ -22,6 +26,10 @@ class BrowserError(Exception):
     def __str__(self):
         return self.msg
 
+class PermanentURLError(BrowserError):
+    # raised by URLOpeners for errors that retrying won't fix
+    pass
+
 class URLOpener(object):
     def open(self, url, headers=None, data=None):
         # open a url and returns a URLRespose
@@ -141,15 +149,475 @@ else:
         def _extractCookieHeaders(self, response, url):
             self.cookiejar.extract_cookies(ResponseProxy(response), urllib2.Request(url))
 
+class PageArchive(object):
+    """
+    An append-only, gzip compressed, WARC-style archive of URL responses.
+    Every record is appended as a separate gzip member to the archive file.
+    A fixed-size hash table index (URL hash to offset) is kept alongside the
+    archive in a separate file and is memory-mapped for O(1) lookups, so
+    previously crawled pages can be re-processed without the network.
+    Responses to POST requests are indexed by URL and POST data so they don't
+    replace the GET response for the same URL. The index header records how
+    much of the archive it covers, so a missing or stale index is brought up
+    to date by scanning the archive. The archive can be shared between
+    threads.
+    """
+    INDEX_MAGIC = "PSIX"
+    INDEX_HEADER = struct.Struct("<4sQQQQ") # magic, capacity, keys, records, archive length
+    INDEX_SLOT = struct.Struct("<16sQQ")    # key digest, offset, length
+    INITIAL_CAPACITY = 1024
+    EMPTY_DIGEST = "\0" * 16
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, path, indexPath=None):
+        import threading
+        self.path = path
+        self.indexPath = indexPath or path + ".idx"
+        self._lock = threading.Lock()
+        self._archive = open(self.path, "a+b")
+        if not os.path.exists(self.indexPath) or os.path.getsize(self.indexPath) == 0:
+            self._create_index()
+        self._indexFile = open(self.indexPath, "r+b")
+        self._map_index()
+
+        # bring the index up to date with records appended after it was last
+        # written, e.g. after a crash
+        self._archive.seek(0, os.SEEK_END)
+        size = self._archive.tell()
+        covered = self._index_header()[4]
+        if covered > size:
+            logger.warning("%s is newer than %s, rebuilding it" % (self.indexPath, self.path))
+            self._reset_index()
+            covered = 0
+        if covered < size:
+            self._update_index(covered, size)
+
+    def add(self, response, url=None, data=None):
+        """
+        Appends a URLResponse to the archive and indexes it by its final URL
+        and, if given and different, by the URL that was originally requested.
+        'data' is the POST data of the request, if any. Later records for the
+        same URL and POST data replace earlier ones in the index.
+        """
+        record = self._compress(self._make_record(response, url, data))
+        self._lock.acquire()
+        try:
+            self._archive.seek(0, os.SEEK_END)
+            offset = self._archive.tell()
+            self._archive.write(record)
+            self._archive.flush()
+            self._index_record(self._keys(response.url, url, data), offset, len(record))
+        finally:
+            self._lock.release()
+
+    def get(self, url, data=None):
+        """
+        Returns the archived URLResponse for a URL (and POST data) or None if
+        it has not been archived.
+        """
+        self._lock.acquire()
+        try:
+            slot = self._index_find(self._digest(self._key(url, data)))
+            if slot is None:
+                return None
+            digest, offset, length = self._read_slot(slot)
+            self._archive.seek(offset)
+            record = self._archive.read(length)
+        finally:
+            self._lock.release()
+        return self._parse_record(self._decompress(record))[1]
+
+    def __contains__(self, url):
+        self._lock.acquire()
+        try:
+            return self._index_find(self._digest(self._key(url))) is not None
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        """Returns the number of records in the archive, as yielded by iteration"""
+        self._lock.acquire()
+        try:
+            return self._index_header()[3]
+        finally:
+            self._lock.release()
+
+    def __iter__(self):
+        """
+        Iterates over all records in the archive in the order they were added,
+        including records that were later replaced in the index. Records are
+        read one at a time, so the archive is never loaded into memory whole.
+        """
+        for offset, length, record in self._records():
+            yield self._parse_record(record)[1]
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._index.flush()
+            self._index.close()
+            self._indexFile.close()
+            self._archive.close()
+        finally:
+            self._lock.release()
+
+    def _records(self, start=0):
+        """
+        Yields (offset, length, record) for every complete gzip member in the
+        archive from 'start' on. A truncated or corrupt member ends the
+        iteration. Uses its own file handle so it doesn't move the shared file
+        position.
+        """
+        import zlib
+        f = open(self.path, "rb")
+        try:
+            f.seek(start)
+            offset = pos = start
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            parts = []
+            while True:
+                chunk = f.read(self.READ_SIZE)
+                if not chunk:
+                    if pos > offset:
+                        if not self._member_ended(decompressor):
+                            logger.warning("ignoring truncated record at offset %d of %s" % (offset, self.path))
+                            return
+                        yield offset, pos - offset, "".join(parts)
+                    return
+                pos += len(chunk)
+                while chunk:
+                    try:
+                        parts.append(decompressor.decompress(chunk))
+                    except zlib.error:
+                        logger.warning("ignoring corrupt record at offset %d of %s" % (offset, self.path))
+                        return
+                    chunk = decompressor.unused_data
+                    if chunk:
+                        # the current member ended inside this chunk
+                        end = pos - len(chunk)
+                        parts.append(decompressor.flush())
+                        yield offset, end - offset, "".join(parts)
+                        offset = end
+                        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                        parts = []
+        finally:
+            f.close()
+
+    def _member_ended(self, decompressor):
+        """
+        Returns True if a decompressor has seen the end of its gzip member.
+        Input fed after the end of a member is left in unused_data.
+        """
+        import zlib
+        try:
+            decompressor.decompress("\0")
+        except zlib.error:
+            return False
+        return bool(decompressor.unused_data)
+
+    def _update_index(self, start, size):
+        """
+        Indexes the records between 'start' and the end of the archive. A torn
+        record left at the end by an interrupted append is cut off, so that
+        records appended later can still be read.
+        """
+        end = start
+        for offset, length, record in self._records(start):
+            try:
+                fields = self._parse_record(record)[0]
+                keys = self._keys(fields["warc-target-uri"], fields.get("pyscrape-request-uri"),
+                    fields.get("pyscrape-request-data"), hashed=True)
+            except (KeyError, ValueError):
+                logger.warning("ignoring malformed record at offset %d of %s" % (offset, self.path))
+                break
+            self._index_record(keys, offset, length)
+            end = offset + length
+        if end < size:
+            logger.warning("truncating %d bytes after the last complete record of %s" % (size - end, self.path))
+            self._archive.truncate(end)
+
+    def _index_record(self, keys, offset, length):
+        for key in keys:
+            self._index_put(self._digest(key), offset, length)
+        magic, capacity, keyCount, records, archiveLength = self._index_header()
+        self.INDEX_HEADER.pack_into(self._index, 0, magic, capacity, keyCount, records + 1, offset + length)
+
+    def _key(self, url, data=None, hashed=False):
+        """
+        Returns the index key for a URL and optional POST data. POST data is
+        included as its md5 hex digest, which is what the records store.
+        """
+        if not data:
+            return bytes(url)
+        if not hashed:
+            data = hashlib.md5(bytes(data)).hexdigest()
+        return bytes(url) + "\0" + data
+
+    def _keys(self, responseUrl, url, data, hashed=False):
+        return set(self._key(u, data, hashed) for u in (responseUrl, url) if u)
+
+    def _make_record(self, response, url=None, data=None):
+        headers = "".join("%s: %s\r\n" % (bytes(k), bytes(v)) for k, v in response.headers.items())
+        block = headers + "\r\n" + bytes(response.data)
+        fields = [
+            ("WARC-Type", "response"),
+            ("WARC-Target-URI", bytes(response.url)),
+            ("WARC-Date", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())),
+        ]
+        if url and bytes(url) != bytes(response.url):
+            fields.append(("Pyscrape-Request-URI", bytes(url)))
+        if data:
+            fields.append(("Pyscrape-Request-Data", hashlib.md5(bytes(data)).hexdigest()))
+        fields.append(("Content-Length", str(len(block))))
+        head = "".join("%s: %s\r\n" % field for field in fields)
+        return "WARC/1.0\r\n" + head + "\r\n" + block + "\r\n\r\n"
+
+    def _parse_record(self, record):
+        """Returns the WARC fields of a record and its URLResponse"""
+        head, _, rest = record.partition("\r\n\r\n")
+        fields = {}
+        for line in head.split("\r\n")[1:]:
+            k, _, v = line.partition(":")
+            fields[k.strip().lower()] = v.strip()
+        block = rest[:int(fields["content-length"])]
+        return fields, self._parse_block(fields["warc-target-uri"], block)
+
+    def _parse_block(self, url, block):
+        headers = {}
+        pos = 0
+        while True:
+            end = block.index("\r\n", pos)
+            line = block[pos:end]
+            pos = end + 2
+            if not line:
+                break
+            k, _, v = line.partition(":")
+            headers[k.strip()] = v.strip()
+        return URLResponse(url, headers, block[pos:])
+
+    def _compress(self, data):
+        import gzip
+        from cStringIO import StringIO
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode="wb")
+        f.write(data)
+        f.close()
+        return buf.getvalue()
+
+    def _decompress(self, data):
+        import gzip
+        from cStringIO import StringIO
+        return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+    def _digest(self, url):
+        return hashlib.md5(url).digest()
+
+    def _make_index(self, capacity, records=0, archiveLength=0):
+        return self.INDEX_HEADER.pack(self.INDEX_MAGIC, capacity, 0, records, archiveLength) + \
+            self.EMPTY_DIGEST.ljust(self.INDEX_SLOT.size, "\0") * capacity
+
+    def _create_index(self):
+        f = open(self.indexPath, "wb")
+        f.write(self._make_index(self.INITIAL_CAPACITY))
+        f.close()
+
+    def _reset_index(self, capacity=None, records=0, archiveLength=0):
+        self._index.close()
+        self._indexFile.seek(0)
+        self._indexFile.truncate()
+        self._indexFile.write(self._make_index(capacity or self.INITIAL_CAPACITY, records, archiveLength))
+        self._indexFile.flush()
+        self._map_index()
+
+    def _map_index(self):
+        import mmap
+        size = os.fstat(self._indexFile.fileno()).st_size
+        if size < self.INDEX_HEADER.size:
+            raise BrowserError("%s is not a pyscrape archive index" % self.indexPath)
+        self._index = mmap.mmap(self._indexFile.fileno(), size)
+        if self._index_header()[0] != self.INDEX_MAGIC:
+            raise BrowserError("%s is not a pyscrape archive index" % self.indexPath)
+
+    def _index_header(self):
+        return self.INDEX_HEADER.unpack_from(self._index, 0)
+
+    def _read_slot(self, slot):
+        return self.INDEX_SLOT.unpack_from(self._index, self.INDEX_HEADER.size + slot * self.INDEX_SLOT.size)
+
+    def _probe(self, digest):
+        """Yields slot numbers for a digest using linear probing"""
+        capacity = self._index_header()[1]
+        start = struct.unpack_from("<Q", digest)[0] % capacity
+        for i in xrange(capacity):
+            yield (start + i) % capacity
+
+    def _index_find(self, digest):
+        for slot in self._probe(digest):
+            slotDigest = self._read_slot(slot)[0]
+            if slotDigest == digest:
+                return slot
+            if slotDigest == self.EMPTY_DIGEST:
+                return None
+        return None
+
+    def _index_put(self, digest, offset, length):
+        magic, capacity, keyCount, records, archiveLength = self._index_header()
+        if (keyCount + 1) * 2 > capacity:
+            self._grow_index(capacity * 2)
+            magic, capacity, keyCount, records, archiveLength = self._index_header()
+        for slot in self._probe(digest):
+            slotDigest = self._read_slot(slot)[0]
+            if slotDigest == self.EMPTY_DIGEST:
+                keyCount += 1
+            elif slotDigest != digest:
+                continue
+            self.INDEX_SLOT.pack_into(self._index, self.INDEX_HEADER.size + slot * self.INDEX_SLOT.size,
+                digest, offset, length)
+            self.INDEX_HEADER.pack_into(self._index, 0, magic, capacity, keyCount, records, archiveLength)
+            return
+
+    def _grow_index(self, capacity):
+        entries = []
+        for slot in xrange(self._index_header()[1]):
+            entry = self._read_slot(slot)
+            if entry[0] != self.EMPTY_DIGEST:
+                entries.append(entry)
+        magic, oldCapacity, keyCount, records, archiveLength = self._index_header()
+        self._reset_index(capacity, records, archiveLength)
+        for entry in entries:
+            self._index_put(*entry)
+
+class ArchivingURLOpener(URLOpener):
+    """
+    Wraps another URLOpener and appends every response it returns to a
+    PageArchive.
+    """
+    def __init__(self, archive, opener):
+        self.archive = archive
+        self.opener = opener
+
+    def open(self, url, headers=None, data=None):
+        response = self.opener.open(url, headers=headers, data=data)
+        self.archive.add(response, url, data)
+        return response
+
+class ArchiveURLOpener(URLOpener):
+    """
+    Serves responses from a PageArchive instead of the network. Use it to
+    re-process previously archived crawls, e.g.
+
+        Browser(openerClass=lambda: ArchiveURLOpener(archive))
+    """
+    def __init__(self, archive):
+        self.archive = archive
+
+    def open(self, url, headers=None, data=None):
+        response = self.archive.get(url, data)
+        if response is None:
+            raise PermanentURLError("%s is not in archive %s" % (url, self.archive.path))
+        return response
+
+class RegexFilter(object):
+    """
+    A page filter that replaces all matches of a precompiled regular
+    expression, removing them by default.
+    """
+    def __init__(self, regexp, replacement="", flags=0):
+        if isinstance(regexp, basestring):
+            regexp = re.compile(regexp, flags)
+        self.regexp = regexp
+        self.replacement = replacement
+
+    def __call__(self, page):
+        return self.regexp.sub(self.replacement, page)
+
+    def __repr__(self):
+        return "<RegexFilter %r>" % self.regexp.pattern
+
+class TagFilter(object):
+    """
+    A page filter that strips all tags with a given name, along with their
+    contents, before the page is parsed (e.g. TagFilter("script")). Nested
+    tags are matched by depth. The contents of raw text elements (script,
+    style, textarea, title) end at the first closing tag. An opening tag that
+    is never closed is stripped on its own, leaving the text after it.
+    """
+    VOID_TAGS = set(["area", "base", "br", "col", "embed", "hr", "img", "input",
+        "link", "meta", "param", "source", "track", "wbr"])
+    RAW_TEXT_TAGS = set(["script", "style", "textarea", "title"])
+
+    def __init__(self, tagName):
+        self.tagName = tagName
+        name = re.escape(tagName)
+        self.regexp = re.compile(r"<(/?)%s(?=[\s/>])[^>]*?(/?)>" % name, re.IGNORECASE)
+        self.closeRegexp = re.compile(r"</%s\s*>" % name, re.IGNORECASE)
+        self.void = tagName.lower() in self.VOID_TAGS
+        self.rawText = tagName.lower() in self.RAW_TEXT_TAGS
+
+    def __call__(self, page):
+        if self.rawText:
+            spans = self._raw_text_spans(page)
+        else:
+            spans = self._element_spans(page)
+        parts = []
+        pos = 0
+        for start, end in spans:
+            if start < pos:
+                continue # nested inside a span that was already stripped
+            parts.append(page[pos:start])
+            pos = end
+        parts.append(page[pos:])
+        return "".join(parts)
+
+    def _raw_text_spans(self, page):
+        spans = []
+        pos = 0
+        while True:
+            m = self.regexp.search(page, pos)
+            if not m:
+                return spans
+            end = m.end()
+            if not m.group(1) and not m.group(2):
+                close = self.closeRegexp.search(page, end)
+                if close:
+                    end = close.end()
+            spans.append((m.start(), end))
+            pos = end
+
+    def _element_spans(self, page):
+        spans = []
+        openTags = []
+        for m in self.regexp.finditer(page):
+            closing, selfClosing = m.group(1), m.group(2)
+            if closing:
+                if openTags:
+                    spans.append((openTags.pop().start(), m.end()))
+                else:
+                    spans.append(m.span())
+            elif selfClosing or self.void:
+                spans.append(m.span())
+            else:
+                openTags.append(m)
+        spans.extend(m.span() for m in openTags)
+        spans.sort()
+        return spans
+
+    def __repr__(self):
+        return "<TagFilter %r>" % self.tagName
+
 class Browser(object):
-    def __init__(self, userAgent="pyscrape/1.0", openerClass=StandardURLOpener):
+    def __init__(self, userAgent="pyscrape/1.0", openerClass=StandardURLOpener, archive=None):
         self._userAgent = userAgent
         self._history = []
         self._opener = openerClass()
+        if archive is not None:
+            self._opener = ArchivingURLOpener(archive, self._opener)
         self.currentUrl = None
         self.headers = {}
         self.page = ""
         self.soup = BeautifulSoup()
+        self.filters = []
+        self.filterTimings = OrderedDict()
         self._reset()
 
     def _reset(self):
@@ -188,11 +656,7 @@ class Browser(object):
 
     @property
     def encoding(self):
-        m = re.search("charset=(.+)$", self.headers.get("content-type"))
-        if m:
-            return m.group(1)
-        else:
-            return None
+        return http_encoding(self.headers)
 
     def duplicate(self):
         """
@@ -204,11 +668,14 @@ class Browser(object):
         newobj._reset()
         return newobj
 
-    def goto(self, url, data=None, retries=3):
+    def goto(self, url, data=None, retries=3, prefetchFrames=False):
         """
         Goes to a URL, optionally passing it POST data.
         The loaded page can be accessed through self.page (as HTML text) and
         self.soup (as BeautifulSoup structure).
+        If prefetchFrames is True, the contents of all frames and iframes on
+        the page are fetched concurrently and attached to self.frames and
+        self.iframes (see Frame.fetch).
         """
         response = self.urlopen(url, data, retries)
 
@@ -216,12 +683,74 @@ class Browser(object):
             self._history.append(url)
         self.currentUrl = response.url
         self.headers = response.headers
-        self.page = response.data
+        self.page, self.filterTimings = self._apply_filters(response.data)
         self.soup = BeautifulSoup(self.page, fromEncoding=self.encoding)
         self._reset()
 
+        if prefetchFrames:
+            self.prefetch_frames()
+
         return self.currentUrl
 
+    def prefetch_frames(self, retries=3, maxThreads=8):
+        """
+        Fetches the contents of all frames and iframes of the current page
+        concurrently, using at most maxThreads connections, without navigating
+        away from it. A frame that fails to load is logged and left unfetched;
+        call its fetch() method to see the error.
+        """
+        import threading
+        import Queue
+        frames = [frame for frame in list(self.frames) + list(self.iframes) if frame.src]
+        queue = Queue.Queue()
+        for frame in frames:
+            queue.put(frame)
+
+        def fetch():
+            while True:
+                try:
+                    frame = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    frame.fetch(retries)
+                except Exception:
+                    logger.warning("failed to prefetch frame %s" % frame.src, exc_info=True)
+
+        threads = [threading.Thread(target=fetch) for i in range(min(maxThreads, len(frames)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def add_filter(self, filter, name=None):
+        """
+        Registers a filter that is applied to every loaded page before it is
+        parsed by BeautifulSoup. Filters run in the order they were added.
+        'filter' can be a regular expression (string or compiled) whose
+        matches are removed, a TagFilter, or any callable that takes the page
+        text and returns the filtered text. The time spent in each filter
+        during the last goto() is kept in self.filterTimings under 'name',
+        which must be unique and defaults to the filter's position and repr.
+        """
+        if isinstance(filter, basestring) or hasattr(filter, "sub"):
+            filter = RegexFilter(filter)
+        elif not callable(filter):
+            raise BrowserError("filter must be a regular expression or a callable, got %r" % (filter,))
+        name = name or "%d: %r" % (len(self.filters), filter)
+        if name in [n for n, f in self.filters]:
+            raise BrowserError("a filter named %r is already registered" % name)
+        self.filters.append((name, filter))
+
+    def _apply_filters(self, page):
+        timings = OrderedDict()
+        for name, filter in self.filters:
+            start = time.time()
+            page = filter(page)
+            timings[name] = time.time() - start
+            logger.debug("filter %s: %.3f sec" % (name, timings[name]))
+        return page, timings
+
     def urlopen(self, url, data=None, retries=3):
         """
         Opens a URL, optionally passing it POST data.
@@ -242,6 +771,8 @@ class Browser(object):
         while True:
             try:
                 return self._opener.open(url, headers=headers, data=data)
+            except PermanentURLError:
+                raise
             except Exception:
                 if retries <= 0:
                     raise
@@ -250,12 +781,7 @@ class Browser(object):
                 retries -= 1
 
     def _get_http_encoding(self):
-        contentType = self.headers.get("content-type")
-        if contentType:
-            m = re.search("charset=(.+)$", contentType)
-            if m:
-                return m.group(1)
-        return None
+        return http_encoding(self.headers)
 
     def back(self):
         if len(self._history) >= 2:
@@ -267,7 +793,8 @@ class Browser(object):
         """
         Remove parts of the HTML using a regular expression and re-parse using
         BeautifulSoup. Use this if BeautifulSoup fails to parse the document
-        correctly.
+        correctly. Kept for compatibility, prefer add_filter() which filters
+        the page before it's parsed for the first time.
         """
         self.page = re.sub(regexp, "", self.page)
         self.soup = BeautifulSoup(self.page)
@@ -335,6 +862,10 @@ class Frame(HtmlObject):
     def __init__(self, browser, soup):
         self.browser = browser
         self.soup = soup
+        self.url = None
+        self.headers = {}
+        self.page = None
+        self.document = None
 
     @property
     def src(self):
@@ -343,6 +874,22 @@ class Frame(HtmlObject):
     def goto(self):
         self.browser.goto(self.src)
 
+    def fetch(self, retries=3):
+        """
+        Loads the contents of the frame without moving the parent Browser
+        away from the current page. The loaded frame can be accessed through
+        self.page (as HTML text) and self.document (as BeautifulSoup
+        structure).
+        """
+        if not self.src:
+            raise BrowserError("frame %s has no src attribute" % self)
+        response = self.browser.urlopen(self.src, retries=retries)
+        self.url = response.url
+        self.headers = response.headers
+        self.page = self.browser._apply_filters(response.data)[0]
+        self.document = BeautifulSoup(self.page, fromEncoding=http_encoding(self.headers))
+        return self.document
+
     def _matches(self, key):
         return key in self.src
 
@@ -493,6 +1040,15 @@ def htmlentitiesdecode(text):
         return text
     return unicode(BeautifulSoup(text, convertEntities=BeautifulSoup.XHTML_ENTITIES))
 
+def http_encoding(headers):
+    """Returns the charset of the content-type in HTTP headers or None"""
+    contentType = headers.get("content-type")
+    if contentType:
+        m = re.search("charset=(.+)$", contentType)
+        if m:
+            return m.group(1)
+    return None
+
 def urljoin(base, url):
     """Joins a base url and a relative path to create an absolute URL"""
     import urlparse
@@ -1,3 +1,4 @@
+import os
 import unittest
 from mock import MagicMock as Mock, patch
 
@@ -57,6 +58,60 @@ class MiscTests(BrowserTestBase):
             with patch("webbrowser.open"):
                 browser.show_in_browser()
 
+    def test_filters(self):
+        self.mockReturnedHtmls["http://www.example.com"] = """\
+<html>
+    <title>Example</title>
+    <script type="text/javascript">document.write("</p>");</script>
+    <SCRIPT src="ads.js" />
+    <!--[if IE]>broken<![endif]-->
+    <a href="one.html">one</a>
+</html>
+"""
+        with self.patch_http_open():
+            browser = pyscrape.Browser()
+            browser.add_filter(pyscrape.TagFilter("script"), name="script")
+            browser.add_filter(r"<!--\[if.*?endif\]-->", name="conditional")
+            browser.add_filter(lambda page: page.replace("Example", "Filtered"))
+            browser.goto("http://www.example.com")
+
+        assert "script" not in browser.page.lower()
+        assert "broken" not in browser.page
+        assert browser.title == "Filtered"
+        assert len(browser.links) == 1
+        assert len(browser.filterTimings) == 3
+        assert browser.filterTimings.keys()[:2] == ["script", "conditional"]
+
+    def test_tag_filter(self):
+        strip = pyscrape.TagFilter("div")
+        assert strip("<p>a</p><div>x<div>y</div>SECRET</div><p>b</p>") == "<p>a</p><p>b</p>"
+        assert strip("<p>a</p><DIV class='x'/><p>b</p></div>") == "<p>a</p><p>b</p>"
+        assert strip("<p>a</p><div>unclosed<p>b</p>") == "<p>a</p>unclosed<p>b</p>"
+        assert pyscrape.TagFilter("br")("a<br>b<br/>c") == "abc"
+        assert pyscrape.TagFilter("p")("<p>one<p>two</p><div>keep</div>") == "one<div>keep</div>"
+        assert pyscrape.TagFilter("script")(
+            "<script>document.write('<script src=\"a.js\"><\\/script>');</script><p>keep</p>") == "<p>keep</p>"
+        assert pyscrape.TagFilter("script")("<script-x>keep</script-x><script>x</script>") == \
+            "<script-x>keep</script-x>"
+
+    def test_unnamed_filter_timings(self):
+        self.mockReturnedHtmls["http://www.example.com"] = "<html><script>x</script>text<br></html>"
+        with self.patch_http_open():
+            browser = pyscrape.Browser()
+            browser.add_filter(pyscrape.TagFilter("script"))
+            browser.add_filter(pyscrape.TagFilter("script"))
+            browser.add_filter("<br>")
+            browser.add_filter("<br>")
+            browser.goto("http://www.example.com")
+
+        assert browser.page == "<html>text</html>"
+        assert len(browser.filterTimings) == 4
+
+    def test_duplicate_filter_name(self):
+        browser = pyscrape.Browser()
+        browser.add_filter("<br>", name="br")
+        self.assertRaises(pyscrape.BrowserError, browser.add_filter, "<hr>", name="br")
+
 class FormTests(BrowserTestBase):
     def test_form(self):
         self.mockReturnedHtmls["http://www.example.com"] = """\
@@ -132,6 +187,87 @@ class FrameTests(BrowserTestBase):
             assert self.last_request().get_full_url() == "http://www.example.com/frame_b.htm"
             assert browserCopy.page == "<html>frame_b</html>"
 
+    def test_prefetch_frames(self):
+        self.mockReturnedHtmls["http://www.example.com"] = """\
+<html>
+    <frameset cols="25%,75%">
+       <frame src="frame_a.htm" />
+       <frame src="frame_b.htm" />
+    </frameset>
+    <iframe src="iframe_c.htm"></iframe>
+</html>
+"""
+        self.mockReturnedHtmls["http://www.example.com/frame_a.htm"] = "<html>frame_a</html>"
+        self.mockReturnedHtmls["http://www.example.com/frame_b.htm"] = "<html>frame_b</html>"
+        self.mockReturnedHtmls["http://www.example.com/iframe_c.htm"] = "<html>iframe_c</html>"
+
+        # frame requests wait until all three are in flight, so fetching the
+        # frames one after another fails instead of passing
+        import threading
+        http_open = self.mock_http_open.side_effect
+        lock = threading.Lock()
+        allStarted = threading.Event()
+        started = []
+        def _http_open(req):
+            if "frame" in req.get_full_url():
+                with lock:
+                    started.append(req.get_full_url())
+                    if len(started) == 3:
+                        allStarted.set()
+                allStarted.wait(1)
+                assert allStarted.is_set(), "frames were not fetched concurrently"
+            return http_open(req)
+        self.mock_http_open.side_effect = _http_open
+
+        with self.patch_http_open():
+            browser = pyscrape.Browser()
+            with patch("time.sleep"):
+                browser.goto("http://www.example.com", prefetchFrames=True)
+
+        assert len(started) == 3
+        assert browser.currentUrl == "http://www.example.com"
+        assert browser.frames.get("frame_a").page == "<html>frame_a</html>"
+        assert browser.frames.get("frame_b").document.find("html").string == "frame_b"
+        assert browser.iframes.get("iframe_c").url == "http://www.example.com/iframe_c.htm"
+        assert browser.iframes.get("iframe_c").page == "<html>iframe_c</html>"
+
+    def test_prefetch_frames_max_threads(self):
+        self.mockReturnedHtmls["http://www.example.com"] = "<html>%s</html>" % "".join(
+            '<iframe src="iframe_%d.htm"></iframe>' % i for i in range(6))
+        for i in range(6):
+            self.mockReturnedHtmls["http://www.example.com/iframe_%d.htm" % i] = "<html>iframe_%d</html>" % i
+
+        import threading
+        http_open = self.mock_http_open.side_effect
+        lock = threading.Lock()
+        inFlight = []
+        maxInFlight = []
+        def _http_open(req):
+            if "iframe" in req.get_full_url():
+                with lock:
+                    inFlight.append(req)
+                    maxInFlight.append(len(inFlight))
+                threading.Event().wait(0.05)
+                with lock:
+                    inFlight.remove(req)
+            return http_open(req)
+        self.mock_http_open.side_effect = _http_open
+
+        with self.patch_http_open():
+            browser = pyscrape.Browser()
+            browser.goto("http://www.example.com")
+            browser.prefetch_frames(maxThreads=2)
+
+        assert max(maxInFlight) == 2
+        assert [f.page for f in browser.iframes] == ["<html>iframe_%d</html>" % i for i in range(6)]
+
+    def test_fetch_frame_without_src(self):
+        self.mockReturnedHtmls["http://www.example.com"] = "<html><iframe></iframe></html>"
+        with self.patch_http_open():
+            browser = pyscrape.Browser()
+            browser.goto("http://www.example.com")
+            self.assertRaises(pyscrape.BrowserError, browser.iframes[0].fetch)
+
 class BackTests(BrowserTestBase):
     def test_back(self):
         self.mockReturnedHtmls["http://www.example.com/1"] = "location1"
@@ -147,3 +283,127 @@ class BackTests(BrowserTestBase):
             browser.goto("3")
             assert self.last_request().get_full_url() == "http://www.example.com/3"
 
+
+class ArchiveTests(BrowserTestBase):
+    def setUp(self):
+        BrowserTestBase.setUp(self)
+        import tempfile
+        self.tempDir = tempfile.mkdtemp(prefix="pyscrape-")
+        self.archivePath = os.path.join(self.tempDir, "crawl.warc.gz")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempDir)
+
+    def test_archive(self):
+        self.mockReturnedHtmls["http://www.example.com"] = "<html><title>archived</title></html>"
+        archive = pyscrape.PageArchive(self.archivePath)
+        with self.patch_http_open():
+            browser = pyscrape.Browser(archive=archive)
+            browser.goto("http://www.example.com")
+        archive.close()
+
+        archive = pyscrape.PageArchive(self.archivePath)
+        assert "http://www.example.com" in archive
+        browser = pyscrape.Browser(openerClass=lambda: pyscrape.ArchiveURLOpener(archive))
+        browser.goto("http://www.example.com")
+        assert browser.page == "<html><title>archived</title></html>"
+        assert browser.title == "archived"
+        assert browser.encoding == "ut8"
+        assert [r.url for r in archive] == ["http://www.example.com"]
+
+    def test_archive_index_growth(self):
+        archive = pyscrape.PageArchive(self.archivePath)
+        for i in range(2000):
+            archive.add(pyscrape.URLResponse("http://www.example.com/%d" % i, {}, "page %d" % i))
+        archive.add(pyscrape.URLResponse("http://www.example.com/7", {}, "page 7 again"))
+        assert len(archive) == 2001
+        assert len(list(archive)) == 2001
+        assert archive.get("http://www.example.com/1999").data == "page 1999"
+        assert archive.get("http://www.example.com/7").data == "page 7 again"
+        assert archive.get("http://www.example.com/missing") is None
+
+    def test_archive_post(self):
+        archive = pyscrape.PageArchive(self.archivePath)
+        archive.add(pyscrape.URLResponse("http://www.example.com/search", {}, "GET result"))
+        archive.add(pyscrape.URLResponse("http://www.example.com/search", {}, "POST result"), data="q=1")
+        assert archive.get("http://www.example.com/search").data == "GET result"
+        assert archive.get("http://www.example.com/search", "q=1").data == "POST result"
+        assert archive.get("http://www.example.com/search", "q=2") is None
+
+    def test_archive_missing_url_not_retried(self):
+        archive = pyscrape.PageArchive(self.archivePath)
+        browser = pyscrape.Browser(openerClass=lambda: pyscrape.ArchiveURLOpener(archive))
+        with patch("time.sleep") as sleep:
+            self.assertRaises(pyscrape.PermanentURLError, browser.goto, "http://www.example.com")
+        assert not sleep.called
+
+    def test_archive_rebuild_index(self):
+        archive = pyscrape.PageArchive(self.archivePath)
+        archive.add(pyscrape.URLResponse("http://www.example.com/final", {}, "redirected"), "http://www.example.com/start")
+        archive.add(pyscrape.URLResponse("http://www.example.com/search", {}, "POST result"), data="q=1")
+        archive.add(pyscrape.URLResponse("http://www.example.com/big", {}, os.urandom(200000)))
+        archive.close()
+        os.remove(self.archivePath + ".idx")
+
+        archive = pyscrape.PageArchive(self.archivePath)
+        assert len(archive) == 3
+        assert len(list(archive)) == 3
+        assert archive.get("http://www.example.com/start").data == "redirected"
+        assert archive.get("http://www.example.com/search", "q=1").data == "POST result"
+        assert len(archive.get("http://www.example.com/big").data) == 200000
+        assert [r.url for r in archive][:2] == ["http://www.example.com/final", "http://www.example.com/search"]
+
+    def test_archive_torn_record(self):
+        archive = pyscrape.PageArchive(self.archivePath)
+        archive.add(pyscrape.URLResponse("http://www.example.com/1", {}, "page 1"))
+        record = archive._compress(archive._make_record(pyscrape.URLResponse("http://www.example.com/2", {}, "page 2")))
+        archive.close()
+        f = open(self.archivePath, "ab")
+        f.write(record[:20])
+        f.close()
+        os.remove(self.archivePath + ".idx")
+
+        archive = pyscrape.PageArchive(self.archivePath)
+        assert len(archive) == 1
+        assert archive.get("http://www.example.com/1").data == "page 1"
+        archive.add(pyscrape.URLResponse("http://www.example.com/3", {}, "page 3"))
+        assert [r.data for r in archive] == ["page 1", "page 3"]
+
+    def test_archive_stale_index(self):
+        archive = pyscrape.PageArchive(self.archivePath)
+        archive.add(pyscrape.URLResponse("http://www.example.com/1", {}, "page 1"))
+        archive.close()
+        # simulate a crash after the archive was written but not the index
+        f = open(self.archivePath + ".idx", "rb")
+        index = f.read()
+        f.close()
+        archive = pyscrape.PageArchive(self.archivePath)
+        archive.add(pyscrape.URLResponse("http://www.example.com/2", {}, "page 2"))
+        archive.close()
+        f = open(self.archivePath + ".idx", "wb")
+        f.write(index)
+        f.close()
+
+        archive = pyscrape.PageArchive(self.archivePath)
+        assert len(archive) == 2
+        assert archive.get("http://www.example.com/2").data == "page 2"
+
+    def test_archive_threads(self):
+        import threading
+        archive = pyscrape.PageArchive(self.archivePath)
+        def add(n):
+            for i in range(100):
+                url = "http://www.example.com/%d/%d" % (n, i)
+                archive.add(pyscrape.URLResponse(url, {}, url))
+                assert archive.get(url).data == url
+        threads = [threading.Thread(target=add, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(archive) == 800
+        for n in range(8):
+            for i in range(100):
+                url = "http://www.example.com/%d/%d" % (n, i)
+                assert archive.get(url).data == url